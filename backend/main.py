@@ -1,15 +1,26 @@
 import os
 import shutil
-from typing import List
+import time
+import uuid
+import asyncio
+import aiofiles
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
 from pathlib import Path
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request 
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from rag import process_files, process_website, ask_question
+from rag import (
+    process_files, process_website, ask_question, ask_question_sync, reset_store
+)
 
-app = FastAPI(title="Multi-Document Research Assistant", version="1.0.0")
+app = FastAPI(
+    title="Multi-Document Research Assistant",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,19 +32,63 @@ app.add_middleware(
 
 @app.exception_handler(500)
 async def http_exception_handler(request: Request, exc: StarletteHTTPException):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"detail": "Processing timeout - try smaller file (under 10MB)"},
         headers={"Access-Control-Allow-Origin": "*"}
     )
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+STATUS_TTL_SECONDS = 5
+ALLOWED_EXTENSIONS = frozenset({".pdf", ".txt", ".docx", ".csv"})
+
 UPLOADS_DIR = Path("./uploads")
 UPLOADS_DIR.mkdir(exist_ok=True)
 INDEX_DIR = Path("./faiss_index")
 INDEX_DIR.mkdir(exist_ok=True)
 
+# In-process indexing jobs started with ?background=true
+MAX_JOBS = 1000
+JOBS: Dict[str, Dict[str, Any]] = {}
+_job_tasks = set()
+
+async def _run_job(job_id: str, fn, *args, upload_dir: Optional[Path] = None):
+    JOBS[job_id]["status"] = "running"
+    try:
+        vectorstore = await asyncio.to_thread(fn, *args)
+        _index_status.cache_clear()
+    except Exception as e:
+        JOBS[job_id].update(status="failed", error=str(e)[:200])
+        return
+    finally:
+        if upload_dir is not None:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+    if vectorstore is None:
+        JOBS[job_id].update(status="failed", error="Indexing failed")
+    else:
+        JOBS[job_id].update(status="done", vectors=vectorstore.index.ntotal)
+
+def _prune_jobs():
+    """Forget the oldest finished jobs once more than MAX_JOBS are tracked."""
+    excess = len(JOBS) - MAX_JOBS
+    if excess <= 0:
+        return
+    finished = [j for j, job in JOBS.items() if job["status"] in ("done", "failed")]
+    for job_id in finished[:excess]:
+        del JOBS[job_id]
+
+def _start_job(fn, *args, job_id: Optional[str] = None, upload_dir: Optional[Path] = None):
+    job_id = job_id or uuid.uuid4().hex
+    _prune_jobs()
+    JOBS[job_id] = {"status": "queued"}
+    task = asyncio.create_task(_run_job(job_id, fn, *args, upload_dir=upload_dir))
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+    return ORJSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+
 class URLRequest(BaseModel):
     url: str
+    urls: List[str] = []
 
 class QuestionRequest(BaseModel):
     query: str
@@ -48,9 +103,9 @@ async def root():
 async def health():
     return {"status": "healthy"}  
 
-@app.get("/status")
-async def status():
-    """Check if index exists AND vectorstore loads."""
+@lru_cache(maxsize=1)
+def _index_status(bucket: int):
+    """Check if index exists AND vectorstore loads; `bucket` expires the result."""
     index_exists = INDEX_DIR.exists() and any(INDEX_DIR.iterdir())
     
     if not index_exists:
@@ -64,37 +119,70 @@ async def status():
     except:
         return {"status": "corrupted", "index_exists": True, "error": "Index corrupted"}
 
+@app.get("/status")
+async def status():
+    # A cache miss may load the encoder and the index; keep it off the event loop
+    return await asyncio.to_thread(_index_status, int(time.time()) // STATUS_TTL_SECONDS)
+
+@app.get("/status/{job_id}")
+async def job_status(job_id: str):
+    """Progress of a background indexing job."""
+    if job_id not in JOBS:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return {"job_id": job_id, **JOBS[job_id]}
+
 
 @app.post("/upload/")
-async def upload_files(files: List[UploadFile] = File(...)):
-    for old_file in UPLOADS_DIR.glob("*"):
-        old_file.unlink()
-    
+async def upload_files(files: List[UploadFile] = File(...), background: bool = False):
+    names = []
+    for file in files:
+        stem, suffix = os.path.splitext(os.path.basename(file.filename))
+        if suffix.lower() not in ALLOWED_EXTENSIONS:
+            raise HTTPException(status_code=400, detail=f"Only PDF/TXT/DOCX/CSV allowed")
+        names.append((stem, suffix))
+
+    # Each request gets its own directory, removed once its files are indexed,
+    # so concurrent or background uploads never touch each other's files.
+    upload_id = uuid.uuid4().hex
+    upload_dir = UPLOADS_DIR / upload_id
+    upload_dir.mkdir()
     file_paths = []
-    allowed_extensions = (".pdf", ".txt", ".docx", ".csv")
     
-    for i, file in enumerate(files):
-        if not file.filename.lower().endswith(allowed_extensions):
-            raise HTTPException(status_code=400, detail=f"Only PDF/TXT/DOCX/CSV allowed")
-        
-        filename = f"{Path(file.filename).stem}_{i:03d}{Path(file.filename).suffix}"
-        temp_path = UPLOADS_DIR / filename
-        
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        file_paths.append(str(temp_path))
+    try:
+        for i, (file, (stem, suffix)) in enumerate(zip(files, names)):
+            temp_path = upload_dir / f"{stem}_{i:03d}{suffix}"
+            
+            async with aiofiles.open(temp_path, "wb") as buffer:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    await buffer.write(chunk)
+            file_paths.append(str(temp_path))
+    except BaseException:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
     
-    vectorstore = process_files(file_paths)
+    if background:
+        return _start_job(process_files, file_paths, job_id=upload_id, upload_dir=upload_dir)
+
+    try:
+        vectorstore = await asyncio.to_thread(process_files, file_paths)
+    finally:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+    _index_status.cache_clear()
     if vectorstore is None:
         raise HTTPException(status_code=500, detail="Failed to process files")
     
     return {"message": f"✅ Indexed {vectorstore.index.ntotal} vectors"}
 
 @app.post("/upload-url/")
-async def upload_url(request: URLRequest):
-    print(f"🌐 Processing URL: {request.url}")
+async def upload_url(request: URLRequest, background: bool = False):
+    urls = [request.url, *request.urls]
+    print(f"🌐 Processing URL: {', '.join(urls)}")
     
-    vectorstore = process_website(request.url)
+    if background:
+        return _start_job(process_website, urls)
+
+    vectorstore = await asyncio.to_thread(process_website, urls)
+    _index_status.cache_clear()
     
     if vectorstore is None:
         raise HTTPException(status_code=500, detail="Website failed to process - check URL or try PDF")
@@ -103,23 +191,34 @@ async def upload_url(request: URLRequest):
     return {"message": f"✅ Website processed! Total vectors: {vectorstore.index.ntotal}"}
 
 
-@app.post("/ask/")
-async def ask(request: QuestionRequest):
+@app.post("/ask/", response_model=None)
+async def ask(request: QuestionRequest) -> Dict[str, Any]:
     if not request.query.strip():
         raise HTTPException(status_code=400, detail="Query required")
     
-    answer = ask_question(request.query)
+    answer = await asyncio.to_thread(ask_question_sync, request.query)
     return {
         "question": request.query,
         "answer": answer,
         "sources": []
     }
 
+@app.post("/ask/stream/")
+async def ask_stream(request: QuestionRequest):
+    """Same as /ask/ but streams the answer as plain text while it is generated."""
+    if not request.query.strip():
+        raise HTTPException(status_code=400, detail="Query required")
+
+    # Resolve the index before any bytes are sent, so errors get a status code
+    try:
+        answer = await asyncio.to_thread(ask_question, request.query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return StreamingResponse(answer, media_type="text/plain; charset=utf-8")
+
 @app.delete("/clear/")
 async def clear_index():
-    if INDEX_DIR.exists():
-        shutil.rmtree(INDEX_DIR)
-    if UPLOADS_DIR.exists():
-        for f in UPLOADS_DIR.glob("*"):
-            f.unlink()
+    await asyncio.to_thread(reset_store)
+    _index_status.cache_clear()
     return {"message": "✅ Cleared"}
@@ -1,24 +1,18 @@
 import os
+import json
+import math
+import atexit
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Union
 from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
 
 load_dotenv()
 os.environ['USER_AGENT'] = 'MultiDocResearchAssistant/1.0'
-
-def _lazy_import(module_name):
-    """Import modules only when needed (Render memory fix)"""
-    imports = {
-        'loaders': lambda: __import__('langchain_community.document_loaders'),
-        'text_splitters': lambda: __import__('langchain_text_splitters'),
-        'faiss': lambda: __import__('langchain_community.vectorstores.faiss'),
-        'embeddings': lambda: __import__('langchain_huggingface'),
-        'groq': lambda: __import__('langchain_groq'),
-        'prompts': lambda: __import__('langchain_core.prompts'),
-        'runnables': lambda: __import__('langchain_core.runnables'),
-        'parsers': lambda: __import__('langchain_core.output_parsers'),
-    }
-    return imports[module_name]()
+WEB_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 if not GROQ_API_KEY:
@@ -26,9 +20,188 @@ if not GROQ_API_KEY:
 
 INDEX_DIR = Path("./faiss_index")
 INDEX_DIR.mkdir(exist_ok=True)
+EMB_CACHE_PATH = Path("./emb_cache.sqlite")
+MANIFEST_NAME = "manifest.json"
+# Manifest entry naming the encoder (cache key) the index was built with
+ENCODER_KEY = "_encoder"
+
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+EMBED_MAX_TOKENS = 256
+# The splitter counts tokens without [CLS]/[SEP]; leave room for both
+CHUNK_TOKENS = EMBED_MAX_TOKENS - 2
+CHUNK_OVERLAP_TOKENS = 32
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+# Search-time recall/latency knobs, applied on build and on every load
+HNSW_EF_SEARCH = int(os.getenv("EF_SEARCH", "64"))
+IVFPQ_MIN_CHUNKS = 10_000
+IVFPQ_M = 16  # PQ sub-quantizers x 8 bits = 16 bytes per vector
+IVFPQ_NPROBE = int(os.getenv("NPROBE", "16"))
+EMBED_BATCH_SIZE = 64
+# Texts handed to the encoder per call; it batches internally by EMBED_BATCH_SIZE
+ENCODE_CALL_SIZE = 4096
+MEMMAP_MIN_CHUNKS = 10_000
+# "auto" = the encoder an existing index was built with; for a new index,
+# torch on CUDA hosts and int8 ONNX Runtime on CPU-only hosts.
+# Vectors from the two differ; an index only accepts the encoder it was built with.
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "auto")
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+
+SAVE_EVERY_CHUNKS = 2000
+RETRIEVAL_K = 4
+MAX_CONTEXT_CHARS = 3000
 
 _embedding_cache = {}
-_vectorstore_cache = {}
+
+# Writable store shared by uploads; flushed to disk periodically and at exit.
+# Single-process only: each process saves its own copy over the index files,
+# so uploads must go to one worker or other workers' vectors are lost.
+_STORE = None
+_unsaved_chunks = 0
+_store_lock = threading.Lock()
+# Fingerprints of indexed files -> their chunk ids; saved with the store.
+_manifest = None
+# Bumped on every index change; keys the retrieval memo.
+_index_generation = 0
+
+def _embedding_device():
+    """Encode on the GPU when torch can see one."""
+    try:
+        import torch
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    except ImportError:
+        return 'cpu'
+
+
+class OnnxEmbeddings(Embeddings):
+    """MiniLM on ONNX Runtime (CPU), by default the hub's dynamic int8 export.
+
+    Mean-pools the last hidden state over the attention mask and
+    L2-normalizes, matching sentence-transformers' output for this model.
+    """
+
+    def __init__(self, model_name: str, onnx_file: str,
+                 batch_size: int = EMBED_BATCH_SIZE, max_length: int = EMBED_MAX_TOKENS):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        subfolder, file_name = os.path.split(onnx_file)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_name,
+            subfolder=subfolder,
+            file_name=file_name,
+            provider="CPUExecutionProvider",
+        )
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def _encode(self, texts: List[str]):
+        import numpy as np
+
+        enc = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        hidden = np.asarray(self.model(**enc).last_hidden_state, dtype=np.float32)
+        mask = enc["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.sqrt(np.einsum("ij,ij->i", pooled, pooled))[:, None]
+        return pooled / np.clip(norms, 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        import numpy as np
+
+        # Length-sorted batches pad less; rows are written back in input order
+        order = np.argsort([len(t) for t in texts])
+        out = np.empty((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        for i in range(0, len(texts), self.batch_size):
+            rows = order[i:i + self.batch_size]
+            out[rows] = self._encode([texts[j] for j in rows])
+        return out.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that reuses chunk vectors from a SQLite cache.
+
+    Keys are sha256(model name + NUL + text), so re-uploaded or lightly
+    edited documents only pay the encoder for chunks it has not seen.
+    Queries are passed straight through.
+    """
+
+    def __init__(self, inner: Embeddings, model_name: str, path: Path = EMB_CACHE_PATH):
+        self.inner = inner
+        self.model_name = model_name
+        self.path = path
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.inner.embed_query(text)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        import numpy as np
+
+        out = np.empty((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        return self.embed_into(texts, out).tolist()
+
+    def embed_into(self, texts: List[str], out):
+        """Fill the float32 matrix `out` with one vector per text."""
+        import hashlib
+        import sqlite3
+        import numpy as np
+        from contextlib import closing
+
+        rows_by_key = {}
+        for i, t in enumerate(texts):
+            key = hashlib.sha256(f"{self.model_name}\0{t}".encode()).hexdigest()
+            rows_by_key.setdefault(key, []).append(i)
+
+        with closing(sqlite3.connect(self.path)) as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_embeddings (hash TEXT PRIMARY KEY, vec BLOB)"
+            )
+
+            unique = list(rows_by_key)
+            hits = set()
+            for i in range(0, len(unique), 500):
+                batch = unique[i:i + 500]
+                rows = db.execute(
+                    f"SELECT hash, vec FROM chunk_embeddings WHERE hash IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+                for h, v in rows:
+                    out[rows_by_key[h]] = np.frombuffer(v, dtype=np.float32)
+                    hits.add(h)
+
+            # Length-sorted so each encoder batch pads to a similar length;
+            # vectors are written back by key, so order is restored for free.
+            missing = sorted(
+                (k for k in unique if k not in hits),
+                key=lambda k: len(texts[rows_by_key[k][0]]),
+            )
+            for i in range(0, len(missing), ENCODE_CALL_SIZE):
+                batch = missing[i:i + ENCODE_CALL_SIZE]
+                vectors = np.asarray(
+                    self.inner.embed_documents([texts[rows_by_key[k][0]] for k in batch]),
+                    dtype=np.float32,
+                )
+                for k, v in zip(batch, vectors):
+                    out[rows_by_key[k]] = v
+                db.executemany(
+                    "INSERT OR REPLACE INTO chunk_embeddings VALUES (?, ?)",
+                    [(k, v.tobytes()) for k, v in zip(batch, vectors)],
+                )
+            db.commit()
+
+        print(f"🧠 Embedded {len(missing)} new chunks, {len(unique) - len(missing)} from cache")
+        return out
+
 
 def get_embeddings():
     """Lightweight embeddings for Render Free Tier."""
@@ -36,14 +209,49 @@ def get_embeddings():
         if 'embeddings' in _embedding_cache:
             return _embedding_cache['embeddings']
         
-        from langchain_huggingface import HuggingFaceEmbeddings
-        
-        print("🔄 Loading lightweight embeddings...")
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': False},
-        )
+        device = _embedding_device()
+        backend, onnx_file = EMBED_BACKEND, EMBED_ONNX_FILE
+        built_with = _index_encoder()
+        if backend == "auto":
+            # An existing index keeps the encoder it was built with
+            if built_with is None:
+                backend = "torch" if device == 'cuda' else "onnx"
+            elif built_with == EMBED_MODEL_NAME:
+                backend = "torch"
+            else:
+                backend = "onnx"
+                onnx_file = built_with.split(":", 1)[1]
+
+        def build(backend):
+            """Return the encoder and the cache key naming its exact weights."""
+            print(f"🔄 Loading lightweight embeddings ({backend} on {device})...")
+            if backend == "onnx":
+                return (
+                    OnnxEmbeddings(EMBED_MODEL_NAME, onnx_file),
+                    f"{EMBED_MODEL_NAME}:{onnx_file}",
+                )
+
+            from langchain_huggingface import HuggingFaceEmbeddings
+            return HuggingFaceEmbeddings(
+                model_name=EMBED_MODEL_NAME,
+                model_kwargs={'device': device},
+                encode_kwargs={
+                    'batch_size': EMBED_BATCH_SIZE,
+                    'normalize_embeddings': True,
+                    'convert_to_numpy': True,
+                },
+            ), EMBED_MODEL_NAME
+
+        try:
+            embeddings, cache_key = build(backend)
+        except Exception as e:
+            # Falling back would make an existing ONNX-built index unusable
+            if backend == "torch" or built_with is not None:
+                raise
+            print(f"⚠️ {backend} embeddings failed ({e}), falling back to FP32 torch")
+            embeddings, cache_key = build("torch")
+
+        embeddings = CachedEmbeddings(embeddings, cache_key)
         _embedding_cache['embeddings'] = embeddings
         print("✅ Lightweight embeddings cached")
         return embeddings
@@ -53,171 +261,586 @@ def get_embeddings():
         raise
 
 
+def load_vectorstore(embeddings, mmap: bool = False):
+    """Read the saved FAISS index with the inner-product metric it was built with.
+
+    With `mmap=True` the vector storage is memory-mapped read-only so
+    query-time workers share the OS page cache. IO_FLAG_MMAP_IFC covers
+    both the HNSW flat codes and IVF lists (plain IO_FLAG_MMAP only maps
+    IVF lists). Stores that will be written to must be loaded without it.
+    """
+    import faiss
+    import pickle
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import DistanceStrategy
+
+    vectorstore = None
+    if mmap:
+        try:
+            index = faiss.read_index(
+                str(INDEX_DIR / "index.faiss"),
+                faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY,
+            )
+            with open(INDEX_DIR / "index.pkl", "rb") as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+            vectorstore = FAISS(
+                embedding_function=embeddings,
+                index=index,
+                docstore=docstore,
+                index_to_docstore_id=index_to_docstore_id,
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            )
+        except Exception as e:
+            print(f"⚠️ mmap load failed ({e}), reading index into memory")
+
+    if vectorstore is None:
+        vectorstore = FAISS.load_local(
+            str(INDEX_DIR),
+            embeddings,
+            allow_dangerous_deserialization=True,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
+    if hasattr(vectorstore.index, "hnsw"):
+        vectorstore.index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif hasattr(vectorstore.index, "nprobe"):
+        vectorstore.index.nprobe = IVFPQ_NPROBE
+    return vectorstore
+
+
+@lru_cache(maxsize=1)
+def _gpu_resources():
+    """Shared FAISS GPU resources, or None on CPU-only hosts."""
+    import faiss
+
+    if not hasattr(faiss, "StandardGpuResources") or faiss.get_num_gpus() == 0:
+        return None
+    return faiss.StandardGpuResources()
+
+
+def _index_to_gpu(index):
+    """Move a search index to GPU 0 when one is present; keep it on CPU otherwise."""
+    import faiss
+
+    try:
+        res = _gpu_resources()
+        if res is None:
+            return index
+        gpu_index = faiss.index_cpu_to_gpu(res, 0, index)
+        print("⚡ Index moved to GPU")
+        return gpu_index
+    except Exception as e:
+        print(f"⚠️ GPU index unavailable ({e}), searching on CPU")
+        return index
+
+
+@lru_cache(maxsize=1)
+def _load_store(mtime: float):
+    """Load the index once per on-disk version; `mtime` is the cache key."""
+    print(f"📂 Loading index from {INDEX_DIR}")
+    vectorstore = load_vectorstore(get_embeddings(), mmap=True)
+    vectorstore.index = _index_to_gpu(vectorstore.index)
+    # A new on-disk version (possibly from another worker) invalidates answers
+    _invalidate_query_caches()
+    print(f"✅ SUCCESS: {vectorstore.index.ntotal} vectors loaded!")
+    return vectorstore
+
+
 def get_vectorstore():
     """Load FAISS index - BULLETPROOF VERSION."""
-    from langchain_community.vectorstores import FAISS
-    
-    if not INDEX_DIR.exists() or not any(INDEX_DIR.iterdir()):
-        print("❌ No index directory")
+    if _STORE is not None:
+        return _STORE
+
+    if not (INDEX_DIR / "index.faiss").exists() or not (INDEX_DIR / "index.pkl").exists():
+        print("❌ No index files")
         raise ValueError("No documents indexed. Upload files first.")
-    
-    embeddings = get_embeddings()
+    _check_encoder(get_embeddings())
     
     try:
-        print(f"📂 Loading index from {INDEX_DIR}")
-        vectorstore = FAISS.load_local(
-            str(INDEX_DIR), 
-            embeddings, 
-            allow_dangerous_deserialization=True
-        )
-        print(f"✅ SUCCESS: {vectorstore.index.ntotal} vectors loaded!")
-        return vectorstore
+        return _load_store((INDEX_DIR / "index.faiss").stat().st_mtime)
     except Exception as e:
         print(f"❌ FAISS load failed: {e}")
         print("🔄 Recreating index...")
         return None
 
 
-def load_documents(file_paths: List[str]):
-    """Load multiple document types - FIXED imports."""
+@contextmanager
+def embedding_buffer(n: int):
+    """Scratch float32 (n, dim) matrix for chunk vectors.
+
+    Large uploads get a disk-backed np.memmap so the full matrix never has
+    to sit in RAM next to the encoder; the temp file is removed on exit.
+    """
+    import tempfile
+    import numpy as np
+
+    if n < MEMMAP_MIN_CHUNKS:
+        yield np.empty((n, EMBEDDING_DIM), dtype=np.float32)
+        return
+
+    fd, path = tempfile.mkstemp(suffix=".emb", dir=INDEX_DIR.parent)
+    os.close(fd)
+    try:
+        yield np.memmap(path, dtype=np.float32, mode="w+", shape=(n, EMBEDDING_DIM))
+    finally:
+        os.remove(path)
+
+
+def add_splits(vectorstore, splits, embeddings, vectors=None):
+    """Add chunks straight to the FAISS index and docstore in one go."""
+    import uuid
+    import numpy as np
+
+    if vectors is None:
+        with embedding_buffer(len(splits)) as buf:
+            embeddings.embed_into([s.page_content for s in splits], buf)
+            return add_splits(vectorstore, splits, embeddings, vectors=buf)
+
+    offset = vectorstore.index.ntotal
+    # no-op for our float32 buffers; guards against lists or strided views
+    vectorstore.index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    ids = [str(uuid.uuid4()) for _ in splits]
+    for split, id_ in zip(splits, ids):
+        split.id = id_
+    vectorstore.docstore.add(dict(zip(ids, splits)))
+    vectorstore.index_to_docstore_id.update(
+        {offset + j: id_ for j, id_ in enumerate(ids)}
+    )
+    return vectorstore
+
+
+def build_index(vectors):
+    """Pick a FAISS index for the corpus size.
+
+    Small corpora get an exact-vector HNSW graph. Large ones get IVF-PQ,
+    which stores compressed codes and has to be trained on the vectors
+    before anything can be added.
+    """
+    import faiss
+    import numpy as np
+
+    if len(vectors) > IVFPQ_MIN_CHUNKS:
+        nlist = int(4 * math.sqrt(len(vectors)))
+        factory = f"IVF{nlist},PQ{IVFPQ_M}x8"
+        print(f"🗜️ Training {factory} on {len(vectors)} vectors...")
+        index = faiss.index_factory(
+            EMBEDDING_DIM, factory, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(np.asarray(vectors, dtype="float32"))
+        index.nprobe = IVFPQ_NPROBE
+        return index
+
+    index = faiss.IndexHNSWFlat(EMBEDDING_DIM, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    return index
+
+
+def create_vectorstore(splits, embeddings):
+    """Build a new FAISS store sized to the corpus instead of a flat scan.
+
+    Embeddings are L2-normalized, so inner product is cosine similarity.
+    """
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import DistanceStrategy
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    with embedding_buffer(len(splits)) as vectors:
+        embeddings.embed_into([s.page_content for s in splits], vectors)
+        vectorstore = FAISS(
+            embedding_function=embeddings,
+            index=build_index(vectors),
+            docstore=InMemoryDocstore({}),
+            index_to_docstore_id={},
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
+        return add_splits(vectorstore, splits, embeddings, vectors=vectors)
+
+
+def _iter_file(path: str, failed=None):
+    """Stream pages/rows of a single file via the loader's lazy_load.
+
+    Errors are logged rather than raised, possibly after some pages were
+    yielded; the path is added to the `failed` set so callers know the
+    file did not load completely.
+    """
     from langchain_community.document_loaders import (
         PyPDFLoader, TextLoader, CSVLoader
     )
-    
-    documents = []
-    for path in file_paths:
-        try:
-            if path.endswith(".pdf"):
-                loader = PyPDFLoader(path)
-            elif path.endswith((".txt", ".md")):
-                loader = TextLoader(path)
-            elif path.endswith(".csv"):
-                loader = CSVLoader(path)
-            else:
-                print(f"⚠️ Skipping unsupported: {path}")
-                continue
 
-            docs = loader.load()
-            documents.extend(docs)
-            print(f"📄 Loaded {len(docs)} pages from {path}")
+    try:
+        if path.endswith(".pdf"):
+            loader = PyPDFLoader(path)
+        elif path.endswith((".txt", ".md")):
+            loader = TextLoader(path)
+        elif path.endswith(".csv"):
+            loader = CSVLoader(path)
+        else:
+            print(f"⚠️ Skipping unsupported: {path}")
+            if failed is not None:
+                failed.add(path)
+            return
 
-        except Exception as e:
-            print(f"❌ Error loading {path}: {e}")
-    return documents
+        count = 0
+        for doc in loader.lazy_load():
+            count += 1
+            yield doc
+        print(f"📄 Loaded {count} pages from {path}")
+
+    except Exception as e:
+        print(f"❌ Error loading {path}: {e}")
+        if failed is not None:
+            failed.add(path)
+
+
+def _load_one(path: str):
+    """Load a single file; runs in a worker process. Returns (docs, ok)."""
+    failed = set()
+    docs = list(_iter_file(path, failed))
+    return docs, not failed
+
+
+def load_documents(file_paths: List[str], failed=None):
+    """Yield documents from multiple files as each one finishes parsing.
+
+    A single file is streamed page by page; several files are parsed in
+    parallel processes and yielded file by file. Paths that failed to
+    load completely are added to `failed`.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    if len(file_paths) <= 1:
+        for path in file_paths:
+            yield from _iter_file(path, failed)
+        return
+
+    workers = min(os.cpu_count() or 1, len(file_paths))
+    # Called from server threads; forking there can copy a lock held by
+    # another thread (stdout, encoder, HTTP client) into the children
+    ctx = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as ex:
+        for path, (docs, ok) in zip(file_paths, ex.map(_load_one, file_paths)):
+            if not ok and failed is not None:
+                failed.add(path)
+            yield from docs
+
+
+@lru_cache(maxsize=1)
+def get_splitter():
+    """Token-aware splitter sized to MiniLM's 256-token window."""
+    from transformers import AutoTokenizer
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_NAME)
+    return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        tokenizer,
+        chunk_size=CHUNK_TOKENS,
+        chunk_overlap=CHUNK_OVERLAP_TOKENS,
+    )
 
 
 def split_documents(docs):
     """Split documents into overlapping chunks."""
-    splitters_mod = _lazy_import('text_splitters')
-    splitter = splitters_mod.RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
+    return get_splitter().split_documents(docs)
+
+def _write_store(vectorstore, folder: Path):
+    """save_local equivalent that pickles the docstore with the newest protocol."""
+    import faiss
+    import pickle
+
+    folder.mkdir(parents=True, exist_ok=True)
+    faiss.write_index(vectorstore.index, str(folder / "index.faiss"))
+    with open(folder / "index.pkl", "wb") as f:
+        pickle.dump(
+            (vectorstore.docstore, vectorstore.index_to_docstore_id),
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    with open(folder / MANIFEST_NAME, "w") as f:
+        json.dump(_get_manifest(), f)
+
+
+def _get_manifest():
+    """Fingerprint -> {"file", "ids"} for every file already in the index."""
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(INDEX_DIR / MANIFEST_NAME) as f:
+                _manifest = json.load(f)
+        except (OSError, ValueError):
+            _manifest = {}
+    return _manifest
+
+
+def _index_encoder():
+    """Encoder the saved index was built with, or None when there is no index.
+
+    Indexes saved before the encoder was recorded were built with torch.
+    """
+    if not (INDEX_DIR / "index.faiss").exists():
+        return None
+    return _get_manifest().get(ENCODER_KEY, EMBED_MODEL_NAME)
+
+
+def _check_encoder(embeddings):
+    """Refuse to search or extend an index built with a different encoder.
+
+    FP32 torch and int8 ONNX vectors live in different spaces. Indexes
+    saved before the encoder was recorded were built with torch. With
+    EMBED_BACKEND=auto this only trips if the index changed under us.
+    """
+    built_with = _get_manifest().get(ENCODER_KEY, EMBED_MODEL_NAME)
+    if built_with != embeddings.model_name:
+        raise ValueError(
+            f"Index was built with {built_with} but the encoder is "
+            f"{embeddings.model_name}. Clear the index and re-upload, "
+            f"or set EMBED_BACKEND to match."
+        )
+
+
+def _file_fingerprint(path: str) -> str:
+    """Content hash of a file; uploads are re-saved each time, so mtime is useless."""
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _record_sources(sources, splits):
+    """Remember which chunk ids each newly indexed file produced.
+
+    Files that produced no chunks (failed or unsupported loads) are left
+    out so the next upload retries them.
+    """
+    if not sources:
+        return
+    ids_by_path = {}
+    for split in splits:
+        ids_by_path.setdefault(split.metadata.get("source"), []).append(split.id)
+    manifest = _get_manifest()
+    for fingerprint, path in sources.items():
+        if path not in ids_by_path:
+            continue
+        manifest[fingerprint] = {
+            "file": os.path.basename(path),
+            "ids": ids_by_path[path],
+        }
+
+
+def save_store():
+    """Flush the in-memory store to disk for other workers and restarts."""
+    global _unsaved_chunks
+    if _STORE is None:
+        return
+    # Write next to the live index, then swap files in so readers in other
+    # workers never see a half-written index. index.faiss goes last because
+    # its mtime is what triggers their reload.
+    tmp_dir = INDEX_DIR.with_name(INDEX_DIR.name + ".tmp")
+    _write_store(_STORE, tmp_dir)
+    INDEX_DIR.mkdir(exist_ok=True)
+    for name in (MANIFEST_NAME, "index.pkl", "index.faiss"):
+        os.replace(tmp_dir / name, INDEX_DIR / name)
+    tmp_dir.rmdir()
+    _load_store.cache_clear()
+    _unsaved_chunks = 0
+    print(f"💾 Saved index with {_STORE.index.ntotal} vectors")
+
+
+def reset_store():
+    """Delete the saved index and forget the in-memory store.
+
+    Runs under the store lock so no save lands in the directory while it
+    is removed; the manifest is dropped only after the files are gone, so
+    a concurrent reader can't reload it from the doomed directory.
+    """
+    import shutil
+
+    global _STORE, _unsaved_chunks, _manifest
+    with _store_lock:
+        if INDEX_DIR.exists():
+            shutil.rmtree(INDEX_DIR)
+        _STORE = None
+        _unsaved_chunks = 0
+        _manifest = None
+        _load_store.cache_clear()
+        _invalidate_query_caches()
+
+
+def _copy_store(vectorstore):
+    """Private copy of a store that can be added to while the original is searched."""
+    import faiss
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    return FAISS(
+        embedding_function=vectorstore.embedding_function,
+        index=faiss.clone_index(vectorstore.index),
+        docstore=InMemoryDocstore(dict(vectorstore.docstore._dict)),
+        index_to_docstore_id=dict(vectorstore.index_to_docstore_id),
+        distance_strategy=vectorstore.distance_strategy,
     )
-    return splitter.split_documents(docs)
+
+
+def index_splits(splits, sources=None):
+    """Add chunks to the shared store, creating it on first use.
+
+    The store stays in memory between uploads; it is only written to disk
+    when first created, every SAVE_EVERY_CHUNKS chunks, and at exit.
+    `sources` maps file fingerprints to paths for the manifest.
+
+    Queries search _STORE without a lock, so a published store is never
+    mutated: new chunks go into a copy that replaces it once complete.
+    """
+    global _STORE, _unsaved_chunks
+    embeddings = get_embeddings()
+
+    with _store_lock:
+        if _STORE is None:
+            try:
+                print("🔄 Loading existing index...")
+                store = load_vectorstore(embeddings)
+                print("✅ Loaded existing index, adding new documents...")
+            except Exception:
+                print("🆕 Creating new index...")
+                _STORE = create_vectorstore(splits, embeddings)
+                _get_manifest()[ENCODER_KEY] = embeddings.model_name
+                _record_sources(sources, splits)
+                save_store()
+                _invalidate_query_caches()
+                return _STORE
+            _check_encoder(embeddings)
+            _get_manifest()[ENCODER_KEY] = embeddings.model_name
+        else:
+            store = _copy_store(_STORE)
+
+        add_splits(store, splits, embeddings)
+        _STORE = store
+        _record_sources(sources, splits)
+        _unsaved_chunks += len(splits)
+        if _unsaved_chunks >= SAVE_EVERY_CHUNKS:
+            save_store()
+        _invalidate_query_caches()
+        return _STORE
+
+
+def _flush_unsaved():
+    """Exit hook: write the store only if it holds chunks not yet on disk."""
+    with _store_lock:
+        if _unsaved_chunks:
+            save_store()
+
+
+atexit.register(_flush_unsaved)
+
 
 def process_files(file_paths: List[str]):
-    """Process and index local files - DIRECT IMPORTS ONLY."""
-    from langchain_community.vectorstores import FAISS
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-    
-    docs = load_documents(file_paths)
-    if not docs:
+    """Process and index local files, skipping ones already in the index."""
+    manifest = _get_manifest()
+    sources = {}
+    for path in file_paths:
+        fingerprint = _file_fingerprint(path)
+        if fingerprint in manifest or fingerprint in sources:
+            print(f"⏭️ Unchanged, skipping: {path}")
+        else:
+            sources[fingerprint] = path
+
+    if not sources:
+        print("✅ All files already indexed")
+        return get_vectorstore()
+
+    splitter = get_splitter()
+    n_docs = 0
+    splits = []
+    failed = set()
+    for doc in load_documents(list(sources.values()), failed):
+        n_docs += 1
+        splits.extend(splitter.split_documents([doc]))
+    # Index what loaded, but don't record partial files so a re-upload retries them
+    sources = {f: p for f, p in sources.items() if p not in failed}
+
+    if not n_docs:
         print("❌ No documents loaded")
         return None
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
-    )
-    splits = splitter.split_documents(docs)
-    print(f"✂️ Split into {len(splits)} chunks")
+    print(f"✂️ Split {n_docs} pages into {len(splits)} chunks")
 
-    embeddings = get_embeddings()
+    vectorstore = index_splits(splits, sources)
+    print(f"📚 Index has {vectorstore.index.ntotal} vectors")
+    return vectorstore
 
-    index_path = str(INDEX_DIR)
-    try:
-        print("🔄 Loading existing index...")
-        vectorstore = FAISS.load_local(
-            index_path, 
-            embeddings, 
-            allow_dangerous_deserialization=True
+async def fetch_pages(urls: List[str]):
+    """Fetch pages concurrently and extract their visible text."""
+    import asyncio
+    import httpx
+    from selectolax.parser import HTMLParser
+    from langchain_core.documents import Document
+
+    async with httpx.AsyncClient(
+        http2=True,
+        timeout=15,
+        follow_redirects=True,
+        headers={'User-Agent': WEB_USER_AGENT},
+    ) as client:
+        responses = await asyncio.gather(
+            *(client.get(u) for u in urls), return_exceptions=True
         )
-        print("✅ Loaded existing index, adding new documents...")
-        vectorstore.add_documents(splits)
-    except:
-        print("🆕 Creating new index...")
-        vectorstore = FAISS.from_documents(splits, embeddings)
-    
-    vectorstore.save_local(index_path)
-    print(f"💾 Saved index with {vectorstore.index.ntotal} vectors")
-    return vectorstore
 
-def process_website(url: str):
-    """Process website - CORRECT WebBaseLoader params."""
-    from langchain_community.document_loaders import WebBaseLoader
-    from langchain_community.vectorstores import FAISS
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-    import requests
-    
+    # One bad URL only drops its own page; fail when every URL failed
+    docs, errors = [], []
+    for url, response in zip(urls, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            response.raise_for_status()
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            print(f"⚠️ Skipping {url}: {str(e).split(chr(10))[0][:100]}")
+            errors.append(e)
+            continue
+        tree = HTMLParser(response.text)
+        for node in tree.css("script, style, noscript"):
+            node.decompose()
+        title = tree.css_first("title")
+        root = tree.body or tree.root
+        docs.append(Document(
+            page_content=root.text(separator="\n", strip=True) if root else "",
+            metadata={"source": url, "title": title.text(strip=True) if title else ""},
+        ))
+    if errors and not docs:
+        raise errors[0]
+    return docs
+
+
+def process_website(url: Union[str, List[str]]):
+    """Process one or more websites fetched concurrently with httpx."""
+    import asyncio
+    import httpx
+
+    urls = [url] if isinstance(url, str) else list(url)
+
     try:
-        print(f"🌐 Fetching website: {url}")
-
-        response = requests.get(
-            url, 
-            timeout=15, 
-            headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-        )
-        response.raise_for_status()
-        print(f"✅ Website OK: {len(response.text)} chars")
-        
-        loader = WebBaseLoader(
-            url,
-            header_template={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            },
-            requests_per_second=0.5
-        )
-        docs = loader.load()
+        print(f"🌐 Fetching {len(urls)} website(s): {', '.join(urls)}")
+        docs = [d for d in asyncio.run(fetch_pages(urls)) if d.page_content.strip()]
 
-        if not docs or not docs[0].page_content.strip():
+        if not docs:
             print("❌ No content extracted")
             return None
 
         print(f"📄 Loaded: {len(docs)} docs")
         
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-        )
-        splits = splitter.split_documents(docs)
+        splits = split_documents(docs)
         print(f"✂️ Split into {len(splits)} chunks")
         
-        embeddings = get_embeddings()
-        index_path = str(INDEX_DIR)
-        
-        try:
-            vectorstore = FAISS.load_local(
-                index_path, embeddings, allow_dangerous_deserialization=True
-            )
-            vectorstore.add_documents(splits)
-            print("✅ Added to existing index")
-        except:
-            vectorstore = FAISS.from_documents(splits, embeddings)
-            print("🆕 Created new index")
-        
-        vectorstore.save_local(index_path)
+        vectorstore = index_splits(splits)
         print(f"🌐 TOTAL: {vectorstore.index.ntotal} vectors")
         return vectorstore
 
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         print("⏰ Website timeout")
         return None
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         print("🔌 Connection failed")
         return None
     except Exception as e:
@@ -226,39 +849,208 @@ def process_website(url: str):
 
 
 
-def ask_question(query: str) -> str:
-    """Answer questions using modern LCEL RAG chain - DIRECT IMPORTS."""
+class SemanticCache:
+    """LRU cache of answers keyed by query embedding.
+
+    Random-hyperplane LSH buckets the (normalized) query vectors; a lookup
+    probes the query's bucket and its 1-bit Hamming neighbours and returns
+    the best cached answer whose cosine similarity clears `threshold`.
+
+    `generation` is bumped by every clear(); put() drops answers computed
+    against an older generation, i.e. before the index last changed.
+    """
+
+    def __init__(self, dim: int, bits: int = 16, threshold: float = 0.95,
+                 max_entries: int = 10_000, max_candidates: int = 50):
+        import numpy as np
+        from collections import OrderedDict
+
+        rng = np.random.default_rng(0)
+        self.planes = rng.standard_normal((bits, dim)).astype(np.float32)
+        self.weights = 1 << np.arange(bits, dtype=np.int64)
+        self.bits = bits
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self.entries = OrderedDict()  # id -> (vec, answer, bucket)
+        self.buckets = {}  # bucket -> set of ids
+        self._next_id = 0
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def _bucket(self, vec) -> int:
+        import numpy as np
+
+        return int(((self.planes @ vec) > 0).astype(np.int64) @ self.weights)
+
+    def get(self, vec):
+        """Cached answer for a near-duplicate query, or None."""
+        import numpy as np
+
+        bucket = self._bucket(vec)
+        probes = [bucket] + [bucket ^ (1 << i) for i in range(self.bits)]
+        with self._lock:
+            candidates = []
+            for b in probes:
+                candidates.extend(self.buckets.get(b, ()))
+                if len(candidates) >= self.max_candidates:
+                    break
+            if not candidates:
+                return None
+            candidates = candidates[:self.max_candidates]
+            sims = np.stack([self.entries[i][0] for i in candidates]) @ vec
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            self.entries.move_to_end(candidates[best])
+            return self.entries[candidates[best]][1]
+
+    def put(self, vec, answer: str, generation: int = None):
+        bucket = self._bucket(vec)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self.entries[entry_id] = (vec, answer, bucket)
+            self.buckets.setdefault(bucket, set()).add(entry_id)
+            while len(self.entries) > self.max_entries:
+                old_id, (_, _, old_bucket) = self.entries.popitem(last=False)
+                self.buckets[old_bucket].discard(old_id)
+                if not self.buckets[old_bucket]:
+                    del self.buckets[old_bucket]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.entries.clear()
+            self.buckets.clear()
+
+
+@lru_cache(maxsize=1)
+def get_answer_cache():
+    """Process-wide semantic answer cache; cleared whenever the index changes."""
+    return SemanticCache(EMBEDDING_DIM)
+
+
+@lru_cache(maxsize=1024)
+def _embed_query(query: str):
+    """Query vector, memoized so the answer cache and retriever share one encode."""
+    return tuple(get_embeddings().embed_query(query))
+
+
+def _retrieve(query: str) -> str:
+    """Top-k context for a query, memoized until the index changes."""
+    return _retrieve_at(query, _index_generation)
+
+
+@lru_cache(maxsize=1024)
+def _retrieve_at(query: str, generation: int) -> str:
+    # `generation` is read before the store, so a search that overlaps an
+    # upload is memoized under the old generation and never served after it
+    docs = get_vectorstore().similarity_search_by_vector(
+        list(_embed_query(query)), k=RETRIEVAL_K
+    )
+    # Shared budget keeps the prompt prefill within MAX_CONTEXT_CHARS: whole
+    # chunks in rank order, only the one that crosses the limit is cut
+    budget = MAX_CONTEXT_CHARS
+    parts = []
+    for doc in docs:
+        if budget <= 0:
+            break
+        parts.append(doc.page_content[:budget])
+        budget -= len(parts[-1])
+    return "\n\n".join(parts)
+
+
+def _invalidate_query_caches():
+    """Drop cached retrievals and answers after the index changes."""
+    global _index_generation
+    _index_generation += 1
+    _retrieve_at.cache_clear()
+    get_answer_cache().clear()
+
+
+@lru_cache(maxsize=1)
+def get_llm():
+    """Create the Groq chat model once and reuse it across questions."""
+    import httpx
     from langchain_groq import ChatGroq
-    from langchain_core.prompts import ChatPromptTemplate
-    from langchain_core.runnables import RunnablePassthrough
-    from langchain_core.output_parsers import StrOutputParser
-    
-    vectorstore = get_vectorstore()
-    
-    llm = ChatGroq(
+
+    return ChatGroq(
         groq_api_key=GROQ_API_KEY,
         model_name="llama-3.1-8b-instant",
-        temperature=0
+        temperature=0,
+        max_retries=2,
+        # keep-alive pool so follow-up questions skip the TLS handshake
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_keepalive_connections=10),
+            timeout=60,
+        ),
     )
 
-    def format_docs(docs):
-        return "\n\n".join(doc.page_content for doc in docs)
-    
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
-    
-    template = """Answer the question based only on the following context:
-{context}
 
-Question: {question}
-Answer:"""
-    
-    prompt = ChatPromptTemplate.from_template(template)
+SYSTEM_PROMPT = (
+    "You are a precise research assistant. Answer the question based only "
+    "on the provided context. If the context does not contain the answer, "
+    "say that you don't know."
+)
+
+
+@lru_cache(maxsize=1)
+def get_chain():
+    """Build the LCEL RAG chain once; it is stateless and safe to reuse."""
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+    from langchain_core.output_parsers import StrOutputParser
+
+    # Static instructions first and per-request text last, so every call
+    # shares the same prompt prefix for the provider's prefix cache.
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", SYSTEM_PROMPT),
+        ("human", "Context:\n{context}\n---\nQuestion: {question}\nAnswer:"),
+    ])
     
-    chain = (
-        {"context": retriever | format_docs, "question": RunnablePassthrough()}
+    return (
+        {"context": RunnableLambda(_retrieve), "question": RunnablePassthrough()}
         | prompt
-        | llm
+        | get_llm()
         | StrOutputParser()
     )
-    
-    return chain.invoke(query)
+
+
+def ask_question(query: str) -> Iterator[str]:
+    """Stream an answer from the LCEL RAG chain token by token.
+
+    Not a generator itself, so a missing or unloadable index raises
+    ValueError here at call time, before a caller has started a
+    streaming response.
+    """
+    if get_vectorstore() is None:
+        raise ValueError("Index could not be loaded. Clear it and upload files again.")
+    return _stream_answer(query)
+
+
+def _stream_answer(query: str) -> Iterator[str]:
+    import numpy as np
+
+    answer_cache = get_answer_cache()
+    # Taken before retrieval, so an upload that lands mid-answer voids the put
+    generation = answer_cache.generation
+    query_vec = np.asarray(_embed_query(query), dtype=np.float32)
+    cached = answer_cache.get(query_vec)
+    if cached is not None:
+        print("⚡ Semantic cache hit")
+        yield cached
+        return
+
+    parts = []
+    for chunk in get_chain().stream(query):
+        parts.append(chunk)
+        yield chunk
+    answer_cache.put(query_vec, "".join(parts), generation)
+
+
+def ask_question_sync(query: str) -> str:
+    """Full answer in one string, for callers that can't stream."""
+    return "".join(ask_question(query))